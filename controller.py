@@ -6,17 +6,54 @@ from ryu.base import app_manager
 from ryu.controller import ofp_event
 from ryu.controller.handler import MAIN_DISPATCHER, CONFIG_DISPATCHER, DEAD_DISPATCHER
 from ryu.controller.handler import set_ev_cls
-from ryu.lib.packet import packet, ethernet, ether_types
+from ryu.lib.packet import ether_types
 from ryu.ofproto import ofproto_v1_3
-from ryu.lib import hub
+from ryu.lib import hub, addrconv
 from ryu.topology import api as topo_api
 from ryu.topology.event import EventSwitchEnter, EventSwitchLeave, EventPortAdd, EventPortDelete
+from ryu.topology.event import EventLinkAdd, EventLinkDelete
+from collections import defaultdict, deque, OrderedDict
+from types import SimpleNamespace
+import functools
+import struct
 import time
 import logging
 
 LOG = logging.getLogger('ryu.app.controller')
 LOG.setLevel(logging.INFO)
 
+# Ethernet header (dst, src, ethertype); MACs stay raw 6-byte strings
+_ETH_HDR = struct.Struct('!6s6sH')
+_ETH = _ETH_HDR.unpack_from
+# raw MAC -> 'aa:bb:cc:dd:ee:ff', needed for OFPMatch fields and log output
+_fmt_mac = addrconv.mac.bin_to_text
+
+# installed flows carry cookie = in_port << 32 | out_port so that the flows
+# entering a dead port can be deleted without touching the rest of the table
+_COOKIE_PORT_MASK = 0xFFFFFFFF
+
+# placeholder MACs serialized into flow templates; their offsets in the
+# packed message are where each packet-in's real MACs get patched in
+_TMPL_SRC = b'\xde\xad\xbe\xef\x00\x01'
+_TMPL_DST = b'\xde\xad\xbe\xef\x00\x02'
+
+try:
+    # compiled with: cythonize -i fastpath.pyx
+    from fastpath import process_pi
+except ImportError:
+    def process_pi(data, in_port, mac_to_port, dpid):
+        """Pure Python fallback for fastpath.process_pi"""
+        if len(data) < _ETH_HDR.size:
+            return None
+        dst, src, ethertype = _ETH(data)
+        if ethertype == ether_types.ETH_TYPE_LLDP:
+            return None
+        key = (dpid, src)
+        prev_port = mac_to_port.get(key)
+        if prev_port != in_port:
+            mac_to_port[key] = in_port
+        return src, dst, prev_port
+
 
 class SimpleFailoverController(app_manager.RyuApp):
     OFP_VERSIONS = [ofproto_v1_3.OFP_VERSION]
@@ -24,13 +61,99 @@ class SimpleFailoverController(app_manager.RyuApp):
     # idle_timeout (seconds) for installed flows
     FLOW_IDLE_TIMEOUT = 30
 
+    # seconds between flow install summaries in the log
+    SUMMARY_INTERVAL = 10
+
+    # flow priorities; both must stay above the table-miss entry (priority 0)
+    LEARNED_FLOW_PRIORITY = 10
+    FLOOD_FLOW_PRIORITY = 5
+    # lifetime (seconds) of flood flows; also used as a hard timeout so an
+    # unknown destination cannot stay unlearned behind a busy flood flow
+    FLOOD_FLOW_TIMEOUT = 2
+
+    # packet-ins from the table-miss entry are rate limited by this meter
+    # on switches that support OpenFlow 1.3 meters
+    TABLE_MISS_METER_ID = 1
+    PACKET_IN_RATE_LIMIT = 500  # packets per second
+
+    # seconds the inter-switch link map from ryu.topology is reused before
+    # being fetched again (it is also dropped on link and port events)
+    LINK_CACHE_TTL = 60
+
+    # opt-in host table: ip -> (dpid, port_no) of its edge port. Once
+    # PROACTIVE_MIN_SWITCHES switches are up, IPv4 flows between every pair
+    # whose hosts have been learned on those ports are pushed along the
+    # shortest path, so established sessions never reach the reactive
+    # learning path. For topology.py's MultiPathTopo that is
+    # {'10.0.0.1': (1, 1), '10.0.0.2': (4, 1)}
+    PROACTIVE_HOSTS = {}
+    PROACTIVE_MIN_SWITCHES = 4
+    PROACTIVE_FLOW_PRIORITY = 20
+
+    # packet-ins are handed to PI_WORKERS green threads per switch through a
+    # bounded queue; packet-ins arriving while it is full are dropped
+    PI_WORKERS = 4
+    PI_QUEUE_SIZE = 1024
+
+    # number of pre-serialized flow mods kept, one per (dpid, in_port, out_port)
+    FLOW_TEMPLATE_CACHE_SIZE = 1024
+
+    # outgoing OpenFlow messages are coalesced per switch and flushed as one
+    # write once the batch reaches TX_BATCH_BYTES or TX_BATCH_MSGS messages,
+    # or is TX_BATCH_DELAY old
+    TX_BATCH_BYTES = 16 * 1024
+    TX_BATCH_MSGS = 64
+    TX_BATCH_DELAY = 0.002
+
     def __init__(self, *args, **kwargs):
         super(SimpleFailoverController, self).__init__(*args, **kwargs)
-        # mac_to_port: dpid -> { mac: port_no }
+        assert 0 < self.FLOOD_FLOW_PRIORITY < self.LEARNED_FLOW_PRIORITY, \
+            "flood flows must sit between the table-miss and learned flows"
+        # mac_to_port: (dpid, mac) -> port_no
         self.mac_to_port = {}
+        # _by_port: (dpid, port_no) -> { mac, ... }, reverse index of mac_to_port
+        self._by_port = defaultdict(set)
+        self._by_port_lock = hub.BoundedSemaphore(1)
+        # _last: dpid -> (dst mac, out_port) of the last successful lookup;
+        # kept per switch so one switch's traffic never evicts another's
+        self._last = {}
+        # global_mac: mac -> (dpid, port_no) where the host is attached
+        self.global_mac = {}
+        # _links: dpid -> { neighbour dpid: local port_no }, cached from
+        # ryu.topology along with the set of (dpid, port_no) link ports
+        self._links = {}
+        self._link_ports = set()
+        self._links_updated = 0
+        # _flows_out: (dpid, out_port) -> { (in_port, src, dst), ... } for the
+        # learned flows installed towards out_port, used to re-point them;
+        # _flow_port: (dpid, in_port, src, dst) -> out_port is its reverse.
+        # Entries are dropped again when the switch reports the flow removed
+        self._flows_out = defaultdict(set)
+        self._flow_port = {}
+        # _seeded is set once every PROACTIVE_HOSTS pair has a flow pushed;
+        # _seeded_once stays set after the first seed so that later re-seeds
+        # are not held back by PROACTIVE_MIN_SWITCHES
+        self._seeded = False
+        self._seeded_once = False
         # datapaths: dpid -> datapath object
         self.datapaths = {}
-        # start a watcher thread for dead datapaths (optional)
+        # _tx_queue: dpid -> [serialized OpenFlow message, ...] awaiting flush
+        self._tx_queue = defaultdict(list)
+        self._tx_bytes = defaultdict(int)
+        # _flow_tmpl: (dpid, in_port, out_port) -> (packed flow mod, src offset,
+        # dst offset), least recently used first
+        self._flow_tmpl = OrderedDict()
+        # _action_cache: (dpid, port_no) -> [OFPActionOutput(port_no)], shared
+        # by every packet-out to that port
+        self._action_cache = {}
+        # _pi_q: dpid -> queue of packet-in messages awaiting a worker
+        self._pi_q = {}
+        # flows installed since the last summary logged by _monitor
+        self._flows_installed = 0
+        self._summary_at = time.time()
+        # set when a switch's tx queue gets its first message; wakes _monitor
+        self._flush_event = hub.Event()
+        # start the thread that flushes batched messages
         self.monitor_thread = hub.spawn(self._monitor)
 
     @set_ev_cls(EventSwitchEnter)
@@ -39,7 +162,19 @@ class SimpleFailoverController(app_manager.RyuApp):
         dpid = dp.id
         LOG.info("Switch entered: %s", dpid)
         self.datapaths[dpid] = dp
-        self.mac_to_port.setdefault(dpid, {})
+        if dpid not in self._pi_q:
+            self._start_pi_workers(dpid)
+        self._seed_proactive()
+
+    @set_ev_cls(EventLinkAdd)
+    def link_add_handler(self, ev):
+        self._links_updated = 0
+        # links are discovered after the switches, so retry seeding here
+        self._seed_proactive()
+
+    @set_ev_cls(EventLinkDelete)
+    def link_delete_handler(self, ev):
+        self._links_updated = 0
 
     @set_ev_cls(EventSwitchLeave)
     def switch_leave_handler(self, ev):
@@ -48,8 +183,37 @@ class SimpleFailoverController(app_manager.RyuApp):
         LOG.info("Switch left: %s", dpid)
         if dpid in self.datapaths:
             del self.datapaths[dpid]
-        if dpid in self.mac_to_port:
-            del self.mac_to_port[dpid]
+        # tear down through the reverse index instead of scanning every
+        # switch's entries in mac_to_port
+        d = self.mac_to_port
+        with self._by_port_lock:
+            for key in [k for k in self._by_port if k[0] == dpid]:
+                for m in self._by_port.pop(key):
+                    d.pop((dpid, m), None)
+        self._last.pop(dpid, None)
+        for mac in [m for m, at in self.global_mac.items() if at[0] == dpid]:
+            del self.global_mac[mac]
+        self._links_updated = 0
+        for key in [k for k in self._flow_tmpl if k[0] == dpid]:
+            del self._flow_tmpl[key]
+        for key in [k for k in self._flows_out if k[0] == dpid]:
+            del self._flows_out[key]
+        for key in [k for k in self._flow_port if k[0] == dpid]:
+            del self._flow_port[key]
+        for key in [k for k in self._action_cache if k[0] == dpid]:
+            del self._action_cache[key]
+        # one stop marker per worker
+        queue = self._pi_q.pop(dpid, None)
+        if queue is not None:
+            for _ in range(self.PI_WORKERS):
+                queue.put(None)
+        # proactive flows are permanent, so the paths through the departed
+        # switch are cleared everywhere and re-seeded over what is left
+        if self._seeded_once:
+            for other in self.datapaths.values():
+                self._delete_proactive(other)
+            self._seeded = False
+            self._seed_proactive()
 
     @set_ev_cls(ofp_event.EventOFPSwitchFeatures, CONFIG_DISPATCHER)
     def switch_features_handler(self, ev):
@@ -57,19 +221,121 @@ class SimpleFailoverController(app_manager.RyuApp):
         ofproto = dp.ofproto
         parser = dp.ofproto_parser
         LOG.info("Switch %s connected (features)", dp.id)
+        # needed by _flush_tx before the switch reaches MAIN_DISPATCHER
+        self.datapaths[dp.id] = dp
+        # constants and constructors used per packet-in, resolved once here
+        # instead of through dp.ofproto / dp.ofproto_parser every time
+        dp._fast = SimpleNamespace(
+            FLOOD=ofproto.OFPP_FLOOD,
+            NB=ofproto.OFP_NO_BUFFER,
+            ActOut=parser.OFPActionOutput,
+            Match=parser.OFPMatch,
+            FlowMod=parser.OFPFlowMod,
+            PktOut=parser.OFPPacketOut,
+            InstrApply=functools.partial(parser.OFPInstructionActions,
+                                         ofproto.OFPIT_APPLY_ACTIONS))
+
+        # install table-miss flow entry (send to controller) right away, then
+        # ask whether the switch supports meters to rate limit it
+        self._add_table_miss(dp)
+        self._enqueue(dp, parser.OFPMeterFeaturesStatsRequest(dp, 0))
 
-        # install table-miss flow entry (send to controller)
+    @set_ev_cls(ofp_event.EventOFPMeterFeaturesStatsReply, MAIN_DISPATCHER)
+    def meter_features_reply_handler(self, ev):
+        """Rate limit the table-miss entry if the switch supports drop meters"""
+        dp = ev.msg.datapath
+        ofproto = dp.ofproto
+        parser = dp.ofproto_parser
+        for stats in ev.msg.body:
+            if (stats.max_meter >= self.TABLE_MISS_METER_ID and
+                    stats.band_types & (1 << ofproto.OFPMBT_DROP) and
+                    stats.capabilities & ofproto.OFPMF_PKTPS):
+                break
+        else:
+            LOG.info("Switch %s has no pktps drop meters, packet-ins not rate limited",
+                     dp.id)
+            return
+
+        bands = [parser.OFPMeterBandDrop(rate=self.PACKET_IN_RATE_LIMIT)]
+        mod = parser.OFPMeterMod(dp, command=ofproto.OFPMC_ADD,
+                                 flags=ofproto.OFPMF_PKTPS,
+                                 meter_id=self.TABLE_MISS_METER_ID, bands=bands)
+        self._enqueue(dp, mod)
+        # re-adding the table-miss entry replaces the unmetered one
+        self._add_table_miss(dp, meter_id=self.TABLE_MISS_METER_ID)
+        LOG.info("Switch %s packet-ins limited to %s pps", dp.id, self.PACKET_IN_RATE_LIMIT)
+
+    def _add_table_miss(self, datapath, meter_id=None):
+        """Install the priority 0 send-to-controller entry, optionally metered"""
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
         match = parser.OFPMatch()
         actions = [parser.OFPActionOutput(ofproto.OFPP_CONTROLLER,
                                           ofproto.OFPCML_NO_BUFFER)]
         inst = [parser.OFPInstructionActions(ofproto.OFPIT_APPLY_ACTIONS, actions)]
-        mod = parser.OFPFlowMod(datapath=dp, priority=0, match=match, instructions=inst)
-        dp.send_msg(mod)
+        if meter_id is not None:
+            inst.insert(0, parser.OFPInstructionMeter(meter_id))
+        mod = parser.OFPFlowMod(datapath=datapath, priority=0, match=match, instructions=inst)
+        self._enqueue(datapath, mod)
+
+    def _enqueue(self, datapath, msg):
+        """Serialize msg and queue it for the next batched write to datapath"""
+        datapath.set_xid(msg)
+        msg.serialize()
+        self._enqueue_buf(datapath.id, msg.buf)
+
+    def _enqueue_barrier(self, datapath):
+        """Queue a barrier so the switch applies what precedes it first"""
+        self._enqueue(datapath, datapath.ofproto_parser.OFPBarrierRequest(datapath))
+
+    def _enqueue_buf(self, dpid, buf):
+        """Queue an already serialized message for the next write to dpid"""
+        queue = self._tx_queue[dpid]
+        if not queue:
+            self._flush_event.set()
+        queue.append(buf)
+        self._tx_bytes[dpid] += len(buf)
+        if (self._tx_bytes[dpid] >= self.TX_BATCH_BYTES or
+                len(queue) >= self.TX_BATCH_MSGS):
+            self._flush_tx(dpid)
+
+    def _flush_tx(self, dpid):
+        """Write all queued messages for dpid at once, followed by a barrier"""
+        bufs = self._tx_queue.pop(dpid, None)
+        self._tx_bytes.pop(dpid, None)
+        if not bufs:
+            return
+        datapath = self.datapaths.get(dpid)
+        if datapath is None:
+            return
+        # the trailing barrier only orders this batch against later ones;
+        # the switch may still reorder messages within the batch, which is
+        # harmless for a packet-out racing its own flow install
+        barrier = datapath.ofproto_parser.OFPBarrierRequest(datapath)
+        datapath.set_xid(barrier)
+        barrier.serialize()
+        bufs.append(barrier.buf)
+        datapath.send(b''.join(bufs))
 
     def _monitor(self):
         while True:
-            # This loop can be extended to poll stats or do periodic tasks
-            hub.sleep(10)
+            # sleep until something is queued, give the batch TX_BATCH_DELAY
+            # to fill up, then flush every switch that has pending messages
+            self._flush_event.wait()
+            self._flush_event.clear()
+            hub.sleep(self.TX_BATCH_DELAY)
+            for dpid in list(self._tx_queue):
+                self._flush_tx(dpid)
+
+            # per-flow logging is too costly on the packet-in path, so flow
+            # installs are only reported in aggregate
+            now = time.time()
+            if now - self._summary_at >= self.SUMMARY_INTERVAL:
+                if self._flows_installed:
+                    LOG.info("Installed %s flows in the last %d seconds",
+                             self._flows_installed, now - self._summary_at)
+                self._flows_installed = 0
+                self._summary_at = now
 
     @set_ev_cls(ofp_event.EventOFPStateChange, [MAIN_DISPATCHER, DEAD_DISPATCHER])
     def state_change_handler(self, ev):
@@ -90,83 +356,487 @@ class SimpleFailoverController(app_manager.RyuApp):
         port_no = ev.port.port_no
         LOG.info("Port deleted on switch %s port %s", dpid, port_no)
         # Remove mac entries that mapped to this port so controller re-learns
-        if dpid in self.mac_to_port:
-            macs_to_remove = [m for m, p in self.mac_to_port[dpid].items() if p == port_no]
-            for m in macs_to_remove:
-                LOG.info("Removing learned MAC %s on switch %s due to port delete", m, dpid)
-                del self.mac_to_port[dpid][m]
-
-            # Optional: flush all flows on this switch to force re-install via new path
-            if dpid in self.datapaths:
-                self._flush_flows(self.datapaths[dpid])
-
-    def _flush_flows(self, datapath):
-        """Delete all non-table-miss flows (priority > 0)"""
+        d = self.mac_to_port
+        with self._by_port_lock:
+            macs = self._by_port.pop((dpid, port_no), set())
+            for m in macs:
+                LOG.info("Removing learned MAC %s on switch %s due to port delete",
+                         _fmt_mac(m), dpid)
+                d.pop((dpid, m), None)
+                if self.global_mac.get(m) == (dpid, port_no):
+                    del self.global_mac[m]
+        self._last.pop(dpid, None)
+        # the link map may include the dead link
+        self._links_updated = 0
+
+        # learned flows leaving through this port are first re-pointed in
+        # place where another path to their destination exists, so no
+        # packet-in burst follows; whatever still uses the port is then
+        # deleted, behind a barrier so the switch cannot apply the delete
+        # before the re-points
+        datapath = self.datapaths.get(dpid)
+        if datapath is not None:
+            self._reroute_flows(datapath, port_no)
+            self._enqueue_barrier(datapath)
+            self._flush_flows(datapath, port_no)
+        # the flush may have cut a proactive path; the new one avoids port_no,
+        # so the deletes cannot hit it whatever order the switch applies them
+        self._seeded = False
+        self._seed_proactive()
+
+    def _flush_flows(self, datapath, port_no):
+        """Delete the flows entering through or leaving by port_no"""
         ofproto = datapath.ofproto
         parser = datapath.ofproto_parser
-        match = parser.OFPMatch()
-        mod = parser.OFPFlowMod(datapath=datapath,
-                                command=ofproto.OFPFC_DELETE,
-                                out_port=ofproto.OFPP_ANY,
-                                out_group=ofproto.OFPG_ANY,
-                                priority=1,
-                                match=match)
-        datapath.send_msg(mod)
-        LOG.info("Flushed flows on switch %s", datapath.id)
+        # in_port sits in the cookie's high word; the leaving half goes by
+        # out_port instead, since a flow re-pointed by _reroute_flows keeps
+        # its old cookie
+        for cookie, cookie_mask, out_port in (
+                (port_no << 32, _COOKIE_PORT_MASK << 32, ofproto.OFPP_ANY),
+                (0, 0, port_no)):
+            mod = parser.OFPFlowMod(datapath=datapath,
+                                    cookie=cookie,
+                                    cookie_mask=cookie_mask,
+                                    command=ofproto.OFPFC_DELETE,
+                                    out_port=out_port,
+                                    out_group=ofproto.OFPG_ANY,
+                                    match=parser.OFPMatch())
+            self._enqueue(datapath, mod)
+        LOG.info("Flushed flows for port %s on switch %s", port_no, datapath.id)
+
+    def _reroute_flows(self, datapath, port_no):
+        """Re-point learned flows leaving through port_no onto another path"""
+        dpid = datapath.id
+        flows = self._flows_out.pop((dpid, port_no), None)
+        if not flows:
+            return
+        # ryu.topology drops the link in the same port-status event that
+        # brought us here, so a fresh read no longer contains it
+        self._links_updated = 0
+        self._refresh_links()
+
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+        rerouted = 0
+        for in_port, src, dst in flows:
+            # flows left alone here are deleted by _flush_flows, and the
+            # switch reports them removed
+            if in_port == port_no:
+                continue
+            dst_at = self.global_mac.get(dst)
+            hops = self._path_hops((dpid, in_port), dst_at) if dst_at else None
+            if hops is None:
+                continue
+            new_port = hops[0][2]
+            if new_port == in_port:
+                # the switch drops output to the ingress port
+                continue
+
+            match = parser.OFPMatch(in_port=in_port, eth_dst=_fmt_mac(dst),
+                                    eth_src=_fmt_mac(src))
+            inst = [parser.OFPInstructionActions(ofproto.OFPIT_APPLY_ACTIONS,
+                                                 self._output_actions(datapath, new_port))]
+            mod = parser.OFPFlowMod(datapath=datapath,
+                                    command=ofproto.OFPFC_MODIFY_STRICT,
+                                    priority=self.LEARNED_FLOW_PRIORITY,
+                                    match=match, instructions=inst)
+            self._enqueue(datapath, mod)
+            self._track_flow(dpid, in_port, new_port, src, dst)
+            # the replies came in through the dead port, and the rest of the
+            # new path has no flows for this pair yet
+            self._install_flow(datapath, new_port, in_port, dst, src)
+            for hop, hop_in, hop_out in hops[1:]:
+                dp = self.datapaths[hop]
+                self._install_flow(dp, hop_in, hop_out, src, dst)
+                self._install_flow(dp, hop_out, hop_in, dst, src)
+            rerouted += 1
+        LOG.info("Rerouted %s flows around port %s on switch %s", rerouted, port_no, dpid)
+
+    def _start_pi_workers(self, dpid):
+        queue = hub.Queue(maxsize=self.PI_QUEUE_SIZE)
+        self._pi_q[dpid] = queue
+        for _ in range(self.PI_WORKERS):
+            hub.spawn(self._pi_worker, queue)
+        return queue
+
+    def _pi_worker(self, queue):
+        while True:
+            msg = queue.get()
+            if msg is None:
+                return
+            try:
+                self._process_pi(msg)
+            except Exception:
+                LOG.exception("Error handling packet-in from switch %s", msg.datapath.id)
 
     @set_ev_cls(ofp_event.EventOFPPacketIn, MAIN_DISPATCHER)
     def packet_in_handler(self, ev):
-        """Handle incoming packets (reactive learning switch)"""
+        """Hand the packet-in to the worker pool of its switch"""
         msg = ev.msg
+        queue = self._pi_q.get(msg.datapath.id)
+        if queue is None:
+            # packet-ins can arrive before the topology reports the switch
+            queue = self._start_pi_workers(msg.datapath.id)
+        if queue.full():
+            return
+        queue.put_nowait(msg)
+
+    def _process_pi(self, msg):
+        """Handle incoming packets (reactive learning switch)"""
         dp = msg.datapath
         dpid = dp.id
-        ofproto = dp.ofproto
-        parser = dp.ofproto_parser
+        if dpid not in self.datapaths:
+            # switch already left; drop what its workers still had queued
+            return
+        f = dp._fast
+        flood = f.FLOOD
 
         in_port = msg.match['in_port']
 
-        pkt = packet.Packet(msg.data)
-        eth = pkt.get_protocols(ethernet.ethernet)[0]
-
-        dst = eth.dst
-        src = eth.src
-
-        # ignore LLDP
-        if eth.ethertype == ether_types.ETH_TYPE_LLDP:
+        # parse the Ethernet header and learn src MAC (ignores LLDP); when
+        # the switch buffered the packet and sent no header, the packet-in
+        # match may still carry the MACs
+        data = msg.data
+        if len(data) < _ETH_HDR.size:
+            data = self._eth_header_from_match(msg.match)
+            if data is None:
+                return
+        learned = process_pi(data, in_port, self.mac_to_port, dpid)
+        if learned is None:
             return
+        src, dst, prev_port = learned
 
-        self.mac_to_port.setdefault(dpid, {})
+        if prev_port != in_port:
+            if prev_port is None:
+                if LOG.isEnabledFor(logging.DEBUG):
+                    LOG.debug("Learned %s on switch %s port %s", _fmt_mac(src), dpid, in_port)
+            else:
+                # src moved ports; the cached lookup may point at the old one
+                self._last.pop(dpid, None)
+            with self._by_port_lock:
+                if prev_port is not None:
+                    self._by_port[(dpid, prev_port)].discard(src)
+                self._by_port[(dpid, in_port)].add(src)
 
-        # learn src MAC
-        if src not in self.mac_to_port[dpid]:
-            LOG.info("Learned %s on switch %s port %s", src, dpid, in_port)
-        self.mac_to_port[dpid][src] = in_port
+        # a host learned on an edge port whose peer is attached to another
+        # switch gets flows along the whole path at once, so the switches
+        # downstream never packet-in for this pair
+        path_port = None
+        if prev_port != in_port or src not in self.global_mac:
+            path_port = self._learn_host(dpid, in_port, src, dst)
 
-        # determine output port
-        out_port = None
-        if dst in self.mac_to_port[dpid]:
-            out_port = self.mac_to_port[dpid][dst]
+        if path_port is not None:
+            out_port = path_port
         else:
-            # destination unknown -> flood
-            out_port = ofproto.OFPP_FLOOD
-
-        # build actions
-        actions = [parser.OFPActionOutput(out_port)]
-
-        # If output is a normal port (not flood), install a flow
-        if out_port != ofproto.OFPP_FLOOD:
-            match = parser.OFPMatch(in_port=in_port, eth_dst=dst, eth_src=src)
-            # install flow with idle_timeout; use priority 10
-            inst = [parser.OFPInstructionActions(ofproto.OFPIT_APPLY_ACTIONS, actions)]
-            mod = parser.OFPFlowMod(datapath=dp, priority=10, match=match,
-                                    instructions=inst, idle_timeout=self.FLOW_IDLE_TIMEOUT)
-            dp.send_msg(mod)
-            LOG.info("Installed flow on %s: %s -> out %s", dpid, dst, out_port)
-
-        # send packet out (for flood or to the known out_port)
+            # determine output port (unknown destination -> flood); consecutive
+            # packet-ins on a switch often share dst, so try the last hit first
+            cached = self._last.get(dpid)
+            if cached is not None and cached[0] == dst:
+                out_port = cached[1]
+            else:
+                out_port = self.mac_to_port.get((dpid, dst))
+                if out_port is None:
+                    out_port = flood
+                else:
+                    self._last[dpid] = (dst, out_port)
+
+            # install a flow for this src/dst pair: a learned flow when the
+            # destination is known, otherwise a short-lived flood flow so the
+            # switch replicates follow-up packets without another packet-in.
+            # Broadcast and multicast get no flood flow: on a looped topology
+            # it would replicate storms at line rate, past the packet-in meter
+            if out_port != flood or not dst[0] & 1:
+                self._install_flow(dp, in_port, out_port, src, dst)
+            if out_port != flood:
+                # dst -> src will almost certainly follow, and src was just
+                # learned on in_port, so install the reverse flow now as well
+                self._install_flow(dp, out_port, in_port, dst, src)
+
+        # send packet out (for flood or to the known out_port); a buffered
+        # packet is released by buffer_id alone, without echoing its bytes
+        actions = self._output_actions(dp, out_port)
         data = None
-        if msg.buffer_id == ofproto.OFP_NO_BUFFER:
+        if msg.buffer_id == f.NB:
+            if len(msg.data) < _ETH_HDR.size:
+                return
             data = msg.data
-        out = parser.OFPPacketOut(datapath=dp, buffer_id=msg.buffer_id,
-                                  in_port=in_port, actions=actions, data=data)
-        dp.send_msg(out)
+        out = f.PktOut(datapath=dp, buffer_id=msg.buffer_id,
+                       in_port=in_port, actions=actions, data=data)
+        self._enqueue(dp, out)
+
+    def _output_actions(self, datapath, port_no):
+        """Return the shared [OFPActionOutput(port_no)] list for datapath"""
+        key = (datapath.id, port_no)
+        actions = self._action_cache.get(key)
+        if actions is None:
+            actions = [datapath._fast.ActOut(port_no)]
+            self._action_cache[key] = actions
+        return actions
+
+    def _learn_host(self, dpid, in_port, src, dst):
+        """Record where src is attached and install the src <-> dst path
+
+        Returns the output port towards dst on dpid if a path was installed.
+        """
+        self._refresh_links()
+        # without a link map every port would look like an edge port
+        if not self._links or (dpid, in_port) in self._link_ports:
+            return None
+        # the first edge sighting wins; only a port delete or switch leave
+        # releases it, so a flooded copy seen on a not yet discovered link
+        # port cannot move the host
+        if self.global_mac.setdefault(src, (dpid, in_port)) != (dpid, in_port):
+            return None
+        if not self._seeded and (dpid, in_port) in self.PROACTIVE_HOSTS.values():
+            self._seed_proactive()
+
+        dst_at = self.global_mac.get(dst)
+        if dst_at is None or dst_at[0] == dpid:
+            return None
+        hops = self._path_hops((dpid, in_port), dst_at)
+        if hops is None:
+            return None
+        for hop, hop_in, hop_out in hops:
+            dp = self.datapaths[hop]
+            self._install_flow(dp, hop_in, hop_out, src, dst)
+            self._install_flow(dp, hop_out, hop_in, dst, src)
+        if LOG.isEnabledFor(logging.DEBUG):
+            LOG.debug("Installed path %s <-> %s via %s", _fmt_mac(src), _fmt_mac(dst),
+                      [hop[0] for hop in hops])
+        return hops[0][2]
+
+    def _seed_proactive(self):
+        """Push IPv4 flows between all PROACTIVE_HOSTS pairs once the topology is up
+
+        A pair is only seeded once a host has been learned on both of its
+        edge ports. The first seed waits for every pair; after that, pairs
+        that are ready are pushed and the rest are retried on the next event.
+        """
+        if self._seeded or not self.PROACTIVE_HOSTS:
+            return
+        if not self._seeded_once and len(self.datapaths) < self.PROACTIVE_MIN_SWITCHES:
+            return
+        # link and port events have already dropped a stale link map
+        self._refresh_links()
+        attached = set(self.global_mac.values()) - self._link_ports
+
+        plans = []
+        complete = True
+        for src_ip, src_at in self.PROACTIVE_HOSTS.items():
+            for dst_ip, dst_at in self.PROACTIVE_HOSTS.items():
+                if src_ip == dst_ip:
+                    continue
+                hops = None
+                if src_at in attached and dst_at in attached:
+                    hops = self._path_hops(src_at, dst_at)
+                if hops is None:
+                    # hosts, links or switches still missing, retry later
+                    if not self._seeded_once:
+                        return
+                    complete = False
+                    continue
+                plans.append((src_ip, dst_ip, hops))
+
+        for src_ip, dst_ip, hops in plans:
+            for hop, hop_in, hop_out in hops:
+                dp = self.datapaths[hop]
+                parser = dp.ofproto_parser
+                match = parser.OFPMatch(in_port=hop_in, eth_type=ether_types.ETH_TYPE_IP,
+                                        ipv4_src=src_ip, ipv4_dst=dst_ip)
+                actions = [parser.OFPActionOutput(hop_out)]
+                inst = [parser.OFPInstructionActions(dp.ofproto.OFPIT_APPLY_ACTIONS,
+                                                     actions)]
+                mod = parser.OFPFlowMod(datapath=dp, cookie=(hop_in << 32) | hop_out,
+                                        priority=self.PROACTIVE_FLOW_PRIORITY,
+                                        match=match, instructions=inst)
+                self._enqueue(dp, mod)
+            LOG.info("Proactive path %s -> %s via %s", src_ip, dst_ip,
+                     [hop[0] for hop in hops])
+        self._seeded = complete
+        self._seeded_once = True
+
+    def _delete_proactive(self, datapath):
+        """Remove the PROACTIVE_FLOW_PRIORITY flows from datapath
+
+        They are the only flows matching on eth_type, so a non-strict delete
+        on eth_type=IP clears them; the barrier keeps a following re-seed
+        from being applied before the delete.
+        """
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+        match = parser.OFPMatch(eth_type=ether_types.ETH_TYPE_IP)
+        mod = parser.OFPFlowMod(datapath=datapath, command=ofproto.OFPFC_DELETE,
+                                priority=self.PROACTIVE_FLOW_PRIORITY,
+                                out_port=ofproto.OFPP_ANY, out_group=ofproto.OFPG_ANY,
+                                match=match)
+        self._enqueue(datapath, mod)
+        self._enqueue_barrier(datapath)
+
+    def _path_hops(self, src_at, dst_at):
+        """Return [(dpid, in_port, out_port), ...] from one edge port to another
+
+        src_at and dst_at are (dpid, port_no) pairs; None is returned when
+        there is no path over the cached links or a switch on it is unknown.
+        """
+        path = self._shortest_path(src_at[0], dst_at[0])
+        if path is None:
+            return None
+        hops = []
+        hop_in = src_at[1]
+        for i, hop in enumerate(path):
+            if hop not in self.datapaths:
+                return None
+            if i + 1 < len(path):
+                hop_out = self._links[hop][path[i + 1]]
+                hops.append((hop, hop_in, hop_out))
+                hop_in = self._links.get(path[i + 1], {}).get(hop)
+                if hop_in is None:
+                    return None
+            else:
+                hops.append((hop, hop_in, dst_at[1]))
+        return hops
+
+    def _refresh_links(self):
+        """Re-read the inter-switch links from ryu.topology if the cache is stale"""
+        now = time.time()
+        if now - self._links_updated < self.LINK_CACHE_TTL:
+            return
+        ports = {}
+        link_ports = set()
+        for link in topo_api.get_all_link(self):
+            ports[(link.src.dpid, link.dst.dpid)] = link.src.port_no
+            link_ports.add((link.src.dpid, link.src.port_no))
+        # LLDP discovers each direction on its own; a link is only usable
+        # for paths once both of its directions are known
+        links = {}
+        for (a, b), port_no in ports.items():
+            if (b, a) in ports:
+                links.setdefault(a, {})[b] = port_no
+        self._links = links
+        self._link_ports = link_ports
+        # attachments recorded on ports that turned out to be links are wrong
+        for mac in [m for m, at in self.global_mac.items() if at in link_ports]:
+            del self.global_mac[mac]
+        # cached even when empty: links discovered later reset the cache
+        # through EventLinkAdd, so packet-ins never wait on ryu.topology
+        self._links_updated = now
+
+    def _shortest_path(self, src_dpid, dst_dpid):
+        """Breadth-first search over the cached links, returns [dpid, ...] or None"""
+        parent = {src_dpid: None}
+        frontier = deque([src_dpid])
+        while frontier:
+            node = frontier.popleft()
+            if node == dst_dpid:
+                path = []
+                while node is not None:
+                    path.append(node)
+                    node = parent[node]
+                return path[::-1]
+            for nbr in self._links.get(node, ()):
+                if nbr not in parent:
+                    parent[nbr] = node
+                    frontier.append(nbr)
+        return None
+
+    @staticmethod
+    def _eth_header_from_match(match):
+        """Rebuild an Ethernet header from packet-in match fields, if present"""
+        try:
+            dst = addrconv.mac.text_to_bin(match['eth_dst'])
+            src = addrconv.mac.text_to_bin(match['eth_src'])
+        except KeyError:
+            return None
+        return _ETH_HDR.pack(dst, src, match.get('eth_type', 0))
+
+    def _install_flow(self, datapath, in_port, out_port, src, dst):
+        """Queue a learned (or, for OFPP_FLOOD, flood) flow for src -> dst"""
+        buf, off_src, off_dst = self._flow_template(datapath, in_port, out_port)
+        buf = bytearray(buf)
+        buf[off_src:off_src + 6] = src
+        buf[off_dst:off_dst + 6] = dst
+        self._enqueue_buf(datapath.id, buf)
+        self._flows_installed += 1
+        if out_port != datapath._fast.FLOOD:
+            self._track_flow(datapath.id, in_port, out_port, src, dst)
+
+    def _track_flow(self, dpid, in_port, out_port, src, dst):
+        """Record that the learned flow for in_port, src -> dst leaves out_port"""
+        flow = (in_port, src, dst)
+        old = self._flow_port.get((dpid,) + flow)
+        if old == out_port:
+            return
+        if old is not None:
+            flows = self._flows_out.get((dpid, old))
+            if flows is not None:
+                flows.discard(flow)
+        self._flow_port[(dpid,) + flow] = out_port
+        self._flows_out[(dpid, out_port)].add(flow)
+
+    def _untrack_flow(self, dpid, in_port, src, dst):
+        """Forget a learned flow the switch no longer has"""
+        flow = (in_port, src, dst)
+        out_port = self._flow_port.pop((dpid,) + flow, None)
+        if out_port is None:
+            return
+        flows = self._flows_out.get((dpid, out_port))
+        if flows is not None:
+            flows.discard(flow)
+            if not flows:
+                del self._flows_out[(dpid, out_port)]
+
+    @set_ev_cls(ofp_event.EventOFPFlowRemoved, MAIN_DISPATCHER)
+    def flow_removed_handler(self, ev):
+        # only learned flows are installed with OFPFF_SEND_FLOW_REM; a flow
+        # re-learned while its removal was in flight is forgotten too, which
+        # at worst leaves it to the port-delete sweep instead of a reroute
+        msg = ev.msg
+        if msg.priority != self.LEARNED_FLOW_PRIORITY:
+            return
+        match = msg.match
+        try:
+            in_port = match['in_port']
+            dst = addrconv.mac.text_to_bin(match['eth_dst'])
+            src = addrconv.mac.text_to_bin(match['eth_src'])
+        except KeyError:
+            return
+        self._untrack_flow(msg.datapath.id, in_port, src, dst)
+
+    def _flow_template(self, datapath, in_port, out_port):
+        """Return the packed flow mod for in_port -> out_port with MAC offsets
+
+        Flow mods for the same port pair only differ in their MACs, so each
+        pair is built and serialized once and later copies are patched.
+        """
+        key = (datapath.id, in_port, out_port)
+        tmpl = self._flow_tmpl.get(key)
+        if tmpl is not None:
+            self._flow_tmpl.move_to_end(key)
+            return tmpl
+
+        f = datapath._fast
+        if out_port == f.FLOOD:
+            priority = self.FLOOD_FLOW_PRIORITY
+            idle_timeout = hard_timeout = self.FLOOD_FLOW_TIMEOUT
+            flags = 0
+        else:
+            priority = self.LEARNED_FLOW_PRIORITY
+            idle_timeout, hard_timeout = self.FLOW_IDLE_TIMEOUT, 0
+            # reported back so _flow_port/_flows_out forget expired flows
+            flags = datapath.ofproto.OFPFF_SEND_FLOW_REM
+        match = f.Match(in_port=in_port, eth_dst=_fmt_mac(_TMPL_DST),
+                        eth_src=_fmt_mac(_TMPL_SRC))
+        inst = [f.InstrApply([f.ActOut(out_port)])]
+        mod = f.FlowMod(datapath=datapath, cookie=(in_port << 32) | out_port,
+                        priority=priority, match=match, instructions=inst,
+                        idle_timeout=idle_timeout, hard_timeout=hard_timeout,
+                        flags=flags)
+        datapath.set_xid(mod)
+        mod.serialize()
+        buf = bytes(mod.buf)
+        tmpl = (buf, buf.index(_TMPL_SRC), buf.index(_TMPL_DST))
+
+        self._flow_tmpl[key] = tmpl
+        if len(self._flow_tmpl) > self.FLOW_TEMPLATE_CACHE_SIZE:
+            self._flow_tmpl.popitem(last=False)
+        return tmpl
@@ -6,9 +6,15 @@ from ryu.controller import ofp_event
 from ryu.controller.handler import CONFIG_DISPATCHER, MAIN_DISPATCHER
 from ryu.controller.handler import set_ev_cls
 from ryu.ofproto import ofproto_v1_3
-from ryu.lib.packet import packet
-from ryu.lib.packet import ethernet
+from ryu.lib import addrconv
 from ryu.lib.packet import ether_types
+import struct
+
+# Ethernet header (dst, src, ethertype); MACs are kept as raw 6-byte strings,
+# which hash faster than Ryu's 'aa:bb:cc:dd:ee:ff' text form
+_ETH = struct.Struct('!6s6sH').unpack_from
+# raw MAC -> text, only needed where OFPMatch or a log message wants it
+_fmt_mac = addrconv.mac.bin_to_text
 
 
 class SimpleRouting(app_manager.RyuApp):
@@ -16,7 +22,7 @@ class SimpleRouting(app_manager.RyuApp):
 
     def __init__(self, *args, **kwargs):
         super(SimpleRouting, self).__init__(*args, **kwargs)
-        self.mac_to_port = {}  # {dpid: {mac: port}}
+        self.mac_to_port = {}  # {dpid: {mac bytes: port}}
 
     @set_ev_cls(ofp_event.EventOFPSwitchFeatures, CONFIG_DISPATCHER)
     def switch_features_handler(self, ev):
@@ -45,15 +51,11 @@ class SimpleRouting(app_manager.RyuApp):
 
         in_port = msg.match['in_port']
 
-        pkt = packet.Packet(msg.data)
-        eth = pkt.get_protocols(ethernet.ethernet)[0]
+        dst, src, ethertype = _ETH(msg.data)
 
-        if eth.ethertype == ether_types.ETH_TYPE_LLDP:
+        if ethertype == ether_types.ETH_TYPE_LLDP:
             return  # Ignore LLDP packets
 
-        dst = eth.dst
-        src = eth.src
-
         # Initialize MAC table for switch
         self.mac_to_port.setdefault(dpid, {})
 
@@ -70,7 +72,8 @@ class SimpleRouting(app_manager.RyuApp):
 
         # Install flow if not flooding
         if out_port != ofproto.OFPP_FLOOD:
-            match = parser.OFPMatch(in_port=in_port, eth_dst=dst, eth_src=src)
+            match = parser.OFPMatch(in_port=in_port, eth_dst=_fmt_mac(dst),
+                                    eth_src=_fmt_mac(src))
             inst = [parser.OFPInstructionActions(ofproto.OFPIT_APPLY_ACTIONS,
                                                  actions)]
             mod = parser.OFPFlowMod(datapath=datapath, priority=10,